@@ -1,16 +1,11 @@
 # -*- coding: utf-8 -*-
-import re, base64, io
+import re, base64, io, hashlib
 from io import BytesIO
 from datetime import datetime, date, time, timezone
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 
 import streamlit as st
-import qrcode
-from qrcode.constants import ERROR_CORRECT_M
-from PIL import Image
-from barcode import Code128
-from barcode.writer import ImageWriter
-from pypdf import PdfReader, PdfWriter
+# segno و barcode و pypdf تُستورد داخل الدوال التي تستخدمها لتسريع بدء التشغيل
 
 # ================= إعداد عام + تنسيق =================
 st.set_page_config(page_title="حاسبة + ZATCA + Code128 + PDF Metadata", page_icon="💰", layout="wide")
@@ -41,12 +36,23 @@ if "qr_initialized" not in st.session_state:
     st.session_state["qr_initialized"] = True
 
 # ================= أدوات مشتركة =================
-def _clean_vat(v: str) -> str: return re.sub(r"\D", "", v or "")
+_NON_DIGIT = re.compile(r"\D")
+
+def _clean_vat(v: str) -> str: return _NON_DIGIT.sub("", v or "")
+
+_Q2 = Decimal("0.01")
 
 def _fmt2(x: str) -> str:
     try: q = Decimal(x)
     except InvalidOperation: q = Decimal("0")
-    return format(q.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP), "f")
+    return format(q.quantize(_Q2, rounding=ROUND_HALF_UP), "f")
+
+def calc_vat(total_incl: float, tax_rate: float):
+    # حساب بالهللات (أعداد صحيحة) مع تقريب النصف لأعلى بدل float + round
+    total_cents = int(round(total_incl * 100))
+    rate_bps = int(round(tax_rate * 100))
+    before_cents = (total_cents * 10000 + (10000 + rate_bps) // 2) // (10000 + rate_bps)
+    return before_cents, total_cents - before_cents
 
 def _iso_utc(d: date, t: time) -> str:
     local_dt = datetime.combine(d, t.replace(microsecond=0))
@@ -55,58 +61,68 @@ def _iso_utc(d: date, t: time) -> str:
     except Exception:
         return local_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-def _tlv(tag: int, val: str) -> bytes:
+def _append_tlv(buf: bytearray, tag: int, val: str) -> None:
     b = val.encode("utf-8")
     if len(b) > 255: raise ValueError("TLV>255B")
-    return bytes([tag, len(b)]) + b
+    buf.append(tag); buf.append(len(b)); buf.extend(b)
 
 def build_zatca_base64(seller, vat, dt_iso, total, vat_s):
-    payload = b"".join([_tlv(1,seller), _tlv(2,vat), _tlv(3,dt_iso), _tlv(4,total), _tlv(5,vat_s)])
-    return base64.b64encode(payload).decode("ascii")
+    buf = bytearray()
+    for tag, val in enumerate((seller, vat, dt_iso, total, vat_s), 1):
+        _append_tlv(buf, tag, val)
+    return base64.b64encode(memoryview(buf)).decode("ascii")
 
 # ================= QR =================
+QR_SCALE = 8  # (73 + 2*4) وحدة × 8 = 648px
+
 def make_qr(b64: str) -> bytes:
-    qr = qrcode.QRCode(version=14, error_correction=ERROR_CORRECT_M, box_size=2, border=4)
-    qr.add_data(b64); qr.make(fit=False)
-    img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-    img = img.resize((640, 640), Image.NEAREST)
-    out = BytesIO(); img.save(out, format="PNG"); return out.getvalue()
+    import segno
+    # segno يكتب PNG مباشرة مع تكرار صحيح للبكسلات دون المرور بـ PIL
+    qr = segno.make(b64, error="m", version=14, micro=False, boost_error=False)
+    out = BytesIO(); qr.save(out, kind="png", scale=QR_SCALE, border=4, compresslevel=1); return out.getvalue()
 
 # ================= Code128 =================
-WIDTH_IN, HEIGHT_IN, DPI = 1.86, 0.34, 600
+WIDTH_IN, HEIGHT_IN = 1.86, 0.34
 ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
 
 def sanitize(s: str) -> str:
+    # رموز الاتجاه كلها خارج ASCII فيحذفها ترشيح ASCII دون تمريرة regex منفصلة
     s = (s or "").translate(ARABIC_DIGITS)
-    s = re.sub(r"[\u200e\u200f\u202a-\u202e\u2066-\u2069\ufeff]", "", s)
-    return "".join(ch for ch in s if ord(ch) < 128).strip()
-
-def render_code128(data: str) -> bytes:
-    code = Code128(data, writer=ImageWriter())
-    buf = BytesIO()
-    code.write(buf, {
+    return s.encode("ascii", "ignore").decode("ascii").strip()
+
+def render_code128(data: str) -> str:
+    from barcode import Code128
+    from barcode.writer import SVGWriter
+    # SVG متجه بالمقاس الفعلي مباشرة؛ المتصفح يرسمه بدقة الشاشة دون PIL أو PNG
+    code = Code128(data, writer=SVGWriter())
+    modules = len(code.build()[0])
+    svg = code.render({
         "write_text": False,
-        "dpi": int(DPI),
-        "module_height": HEIGHT_IN * 25.4,
+        "module_width": WIDTH_IN * 25.4 / modules,
+        "module_height": HEIGHT_IN * 25.4 - 2.0,  # SVGWriter يضيف هامشًا رأسيًا 1mm أعلى وأسفل
         "quiet_zone": 0.0,
         "background": "white",
         "foreground": "black",
     })
-    return buf.getvalue()
-
-def resize_code128(png_bytes: bytes) -> bytes:
-    with Image.open(BytesIO(png_bytes)) as im:
-        im = im.resize((int(WIDTH_IN*DPI), int(HEIGHT_IN*DPI)), Image.NEAREST)
-        out = BytesIO(); im.save(out, format="PNG", dpi=(DPI, DPI))
-        return out.getvalue()
+    return svg.decode("utf-8")
 
 # ================= PDF Metadata =================
 BASE_KEYS = ["/ModDate","/CreationDate","/Producer","/Title","/Author","/Subject","/Keywords","/Creator"]
 
+_PDF_DATE_RE = re.compile(r"(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})(\d{2})")
+_DISPLAY_RE = re.compile(r"\s*(\d{1,2})/(\d{1,2})/(\d{4}),\s+(\d{1,2}):(\d{1,2}):(\d{1,2})\s*")
+
+def _parse_display(s: str) -> datetime:
+    # بديل strptime للصيغة الثابتة "%d/%m/%Y, %H:%M:%S"
+    m = _DISPLAY_RE.fullmatch(s)
+    if not m: raise ValueError(f"bad display date: {s!r}")
+    d,M,y,H,m_,sec = map(int, m.groups())
+    return datetime(y,M,d,H,m_,sec)
+
 def pdf_date_to_display_date(s):
     if not s or not isinstance(s, str): return ""
     if s.startswith("D:"): s = s[2:]
-    m = re.match(r"^(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})(\d{2})", s)
+    m = _PDF_DATE_RE.match(s)
     if m:
         y,M,d,H,m_,sec = m.groups()
         try: return datetime(int(y),int(M),int(d),int(H),int(m_),int(sec)).strftime("%d/%m/%Y, %H:%M:%S")
@@ -114,32 +130,52 @@ def pdf_date_to_display_date(s):
     return s
 
 def display_date_to_pdf_date(s):
-    try: return datetime.strptime(s,"%d/%m/%Y, %H:%M:%S").strftime("D:%Y%m%d%H%M%S+03'00'")
+    try: return _parse_display(s).strftime("D:%Y%m%d%H%M%S+03'00'")
     except: return s
 
 def parse_display_dt(s: str):
     try:
-        dt = datetime.strptime(s.strip(), "%d/%m/%Y, %H:%M:%S")
+        dt = _parse_display(s.strip())
         return dt.date(), dt.time().replace(microsecond=0)
     except Exception:
         return None, None
 
-def read_meta(file):
-    file.seek(0); r = PdfReader(file); md = r.metadata or {}
+def file_digest(file) -> bytes:
+    return hashlib.blake2b(file.getvalue(), digest_size=16).digest()
+
+def _open_pdf(data, digest):
+    from pypdf import PdfReader
+    # قارئ واحد لكل جلسة: PdfReader يقرأ الكائنات بكسل عبر seek على تدفقه فلا يُشارك بين الجلسات
+    cached = st.session_state.get("_pdf_reader")
+    if cached and cached[0] == digest: return cached[1]
+    r = PdfReader(BytesIO(data))
+    st.session_state["_pdf_reader"] = (digest, r)
+    return r
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _read_meta_cached(digest, _data):
+    # المفتاح هو بصمة المحتوى؛ _data لا يُجزَّأ من قبل Streamlit ولا يُفتح القارئ إلا عند عدم الإصابة
+    md = _open_pdf(_data, digest).metadata or {}
     keys = BASE_KEYS + [k for k in md.keys() if k not in BASE_KEYS]
     out = {}
     for k in keys:
         v = md.get(k, "")
-        out[k] = pdf_date_to_display_date(v) if k in ("/CreationDate","/ModDate") else v
+        out[k] = pdf_date_to_display_date(v) if k in ("/CreationDate","/ModDate") else str(v)
     return out, keys
 
-def write_meta(file, new_md):
-    file.seek(0)
-    r = PdfReader(file); w = PdfWriter()
-    for p in r.pages: w.add_page(p)
+def read_meta(file, digest=None):
+    if digest is None: digest = file_digest(file)
+    return _read_meta_cached(digest, file.getvalue())
+
+def write_meta(file, new_md, digest=None):
+    from pypdf import PdfWriter
+    if digest is None: digest = file_digest(file)
+    # تحديث تزايدي: تُنسخ بايتات الملف الأصلي كما هي ويُلحق بها /Info و xref الجديدان فقط
+    r = _open_pdf(file.getvalue(), digest); w = PdfWriter(r, incremental=True)
     final = {}
     for k,v in new_md.items():
         final[k] = display_date_to_pdf_date(v) if k in ("/CreationDate","/ModDate") else v
+    w.add_metadata(final)
     out = io.BytesIO(); w.write(out); out.seek(0); return out
 
 # =========================================================
@@ -155,28 +191,29 @@ with c1:
     colA, colB = st.columns(2)
     with colA:
         if st.button("احسب الآن"):
-            rate = tax_rate/100.0
-            before = round(total_incl/(1+rate), 2)
-            vat_amount = round(total_incl - before, 2)
-            st.success(f"قبل الضريبة: {before:.2f} | الضريبة: {vat_amount:.2f}")
+            before_c, vat_c = calc_vat(total_incl, tax_rate)
+            st.success(f"قبل الضريبة: {before_c/100:.2f} | الضريبة: {vat_c/100:.2f}")
     with colB:
         if st.button("📤 إرسال القيم إلى مولّد QR"):
-            rate = tax_rate/100.0 if tax_rate else 0.0
-            before = round(total_incl/(1+rate), 2) if total_incl and rate else 0.0
-            vat_amount = round(total_incl - before, 2) if total_incl and rate else 0.0
+            _, vat_c = calc_vat(total_incl, tax_rate)
             st.session_state["qr_total"] = f"{total_incl:.2f}"
-            st.session_state["qr_vat"]   = f"{vat_amount:.2f}"
+            st.session_state["qr_vat"]   = f"{vat_c/100:.2f}"
             st.toast("تم إرسال الإجمالي والضريبة إلى قسم مولّد QR ✅")
 
 with c2:
     st.header("📑 PDF Metadata")
     up = st.file_uploader("تحميل PDF", type=["pdf"])
     if up:
-        if "meta_dict" not in st.session_state or st.session_state.get("_last_file_name") != up.name:
-            meta, keys = read_meta(up)
+        # البصمة تُحسب مرة واحدة لكل رفع (file_id) لا مع كل إعادة تشغيل
+        fid, digest = st.session_state.get("_upload_digest", (None, None))
+        if fid != up.file_id:
+            digest = file_digest(up)
+            st.session_state["_upload_digest"] = (up.file_id, digest)
+        if "meta_dict" not in st.session_state or st.session_state.get("_last_file_hash") != digest:
+            meta, keys = read_meta(up, digest)
             st.session_state.meta_keys = keys
             st.session_state.meta_dict = meta
-            st.session_state._last_file_name = up.name
+            st.session_state._last_file_hash = digest
             for k, v in meta.items():
                 if k not in st.session_state:
                     st.session_state[k] = v
@@ -217,8 +254,11 @@ with c2:
                 st.error("صيغة CreationDate غير صحيحة. الصيغة: dd/mm/YYYY, HH:MM:SS")
 
         if st.button("حفظ Metadata"):
-            out = write_meta(up, updated)
+            out = write_meta(up, updated, digest)
             st.download_button("تحميل الملف المعدّل", data=out, file_name=up.name, mime="application/pdf")
+    else:
+        # تحرير القارئ المحلَّل ونسخة البايتات عند إزالة الملف
+        st.session_state.pop("_pdf_reader", None)
 
 # =========================================================
 c3, c4 = st.columns(2)
@@ -230,10 +270,9 @@ with c3:
         s = sanitize(v)
         if not s: st.error("أدخل قيمة.")
         else:
-            raw = render_code128(s)
-            final = resize_code128(raw)
-            st.image(final, caption=f"{WIDTH_IN}×{HEIGHT_IN} inch @ {DPI} DPI")
-            st.download_button("⬇️ تحميل", final, "code128.png", "image/png")
+            final = render_code128(s)
+            st.image(final, caption=f"{WIDTH_IN}×{HEIGHT_IN} inch (SVG)")
+            st.download_button("⬇️ تحميل", final, "code128.svg", "image/svg+xml")
 
 with c4:
     st.header("🔖 مولّد QR (ZATCA)")
@@ -261,6 +300,11 @@ with c4:
                 _fmt2(st.session_state["qr_vat"])
             )
             st.code(b64, language="text")
-            img = make_qr(b64)
+            # Streamlit يعيد تنفيذ السكربت كاملًا مع كل تفاعل؛ نحتفظ بآخر QR في الجلسة
+            last = st.session_state.get("_last_qr")
+            if last and last[0] == b64: img = last[1]
+            else:
+                img = make_qr(b64)
+                st.session_state["_last_qr"] = (b64, img)
             st.image(img, caption="رمز QR ZATCA")
             st.download_button("⬇️ تحميل QR", img, "zatca_qr.png", "image/png")